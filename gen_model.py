@@ -2,210 +2,703 @@
 
 import sqlite3
 import re
-from datetime import datetime
-import chromadb
-import ollama
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 import json
+from storage import DB_NAME, CHROMA_PATH, COLLECTION_NAME, EMBEDDING_MODEL, create_indexes
+
+logger = logging.getLogger(__name__)
+
+# Запись логов в stderr выполняется в отдельном потоке, а не в потоке обработки вопроса
+def setup_logging(level=logging.INFO):
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener.start()
+    return listener
+
+# Разделители диапазона дат: «с ... по ...», «от ... до ...», «... - ...» (тире отделено пробелами,
+# чтобы не разрезать ISO-даты)
+DATE_RANGE_SPLIT_RE = re.compile(r'(?:^|\s+)(?:с|по|от|до)\s+|\s+[-–—]\s+')
+
+# Шаблоны известных вопросов, на которые можно ответить без обращения к модели.
+# Вопрос должен совпасть с шаблоном целиком (допускается только знак препинания в конце):
+# вопрос с дополнительными условиями (креатор, дата, лайки...) уходит модели
+DATE_PATTERN = r'\d{1,2}\s+[а-яё]+\.?\s+\d{4}'
+QUESTION_END = r'[\s?.!]*'
+CREATOR_RANGE_RE = re.compile(
+    rf'сколько\s+(?:всего\s+)?видео\s+у\s+креатора\s+с\s+id\s+([\w-]+)\s+вышло\s+'
+    rf'с\s+({DATE_PATTERN})\s+по\s+({DATE_PATTERN})(?:\s+включительно)?{QUESTION_END}',
+    re.IGNORECASE
+)
+VIEWS_MORE_THAN_RE = re.compile(
+    rf'сколько\s+(?:всего\s+)?видео\s+набрал[оаи]?\s+больше\s+(\d+(?:\s\d{{3}})*)\s+просмотр(?:а|ов)?'
+    rf'(?:\s+за\s+вс[её]\s+время)?{QUESTION_END}',
+    re.IGNORECASE
+)
+VIEWS_GROWTH_RE = re.compile(
+    rf'на\s+сколько\s+просмотров\s+(?:в\s+сумме\s+)?выросл[иао]?\s+все\s+видео\s+(?:за\s+)?({DATE_PATTERN}){QUESTION_END}',
+    re.IGNORECASE
+)
+NEW_VIEWS_RE = re.compile(
+    rf'сколько\s+разных\s+видео\s+получал[аои]?\s+новые\s+просмотры\s+(?:за\s+)?({DATE_PATTERN}){QUESTION_END}',
+    re.IGNORECASE
+)
+VIDEO_COUNT_RE = re.compile(
+    rf'сколько\s+(?:всего\s+)?видео\s+(?:есть\s+)?в\s+системе(?:\s+за\s+вс[её]\s+время)?{QUESTION_END}',
+    re.IGNORECASE
+)
+
+# JSON-объект внутри ответа модели, если вокруг него есть лишний текст
+JSON_OBJECT_RE = re.compile(r'\{[\s\S]*\}')
+
+# Методы, которые может выбрать модель, и их параметры
+AVAILABLE_METHODS = {
+    'get_video_count': {
+        'description': 'получить общее количество видео в системе',
+        'params': []
+    },
+    'get_videos_by_creator_in_date_range': {
+        'description': 'получить количество видео у креатора в диапазоне дат, date_range в виде «с 1 ноября 2025 по 5 ноября 2025»',
+        'params': ['creator_id', 'date_range']
+    },
+    'get_videos_with_views_more_than': {
+        'description': 'получить количество видео с просмотрами больше указанного значения',
+        'params': ['views_threshold']
+    },
+    'get_total_views_growth_on_date': {
+        'description': 'получить суммарный рост просмотров за указанную дату',
+        'params': ['date']
+    },
+    'get_unique_videos_with_new_views_on_date': {
+        'description': 'получить количество уникальных видео с новыми просмотрами за указанную дату',
+        'params': ['date']
+    }
+}
+
+# Неизменная часть промпта собирается один раз при импорте
+METHODS_DESCRIPTION = '\n'.join(
+    f"    {number}. {name}({', '.join(info['params'])}) - {info['description']}"
+    for number, (name, info) in enumerate(AVAILABLE_METHODS.items(), 1)
+)
+PROMPT_INSTRUCTIONS = f"""    Инструкции:
+    1. Проанализируй вопрос и контекст.
+    2. Определи, какой метод нужно вызвать для получения ответа.
+    3. Извлеки необходимые параметры из вопроса.
+    4. Верни ответ в формате JSON с полями:
+    - method: название метода
+    - params: параметры для метода
+    Даты указывай так же, как в вопросе, например «28 ноября 2025».
+
+    Доступные методы:
+{METHODS_DESCRIPTION}"""
+
+# Промпт = PROMPT_HEAD + контекст + PROMPT_QUESTION + вопрос + PROMPT_TAIL
+PROMPT_HEAD = 'Контекст:\n    '
+PROMPT_QUESTION = '\n\n    Вопрос: '
+PROMPT_TAIL = '\n\n' + PROMPT_INSTRUCTIONS
+
+# Промпт для нескольких вопросов сразу (см. VideoAnalytics.ask_model_batch)
+PROMPT_BATCH_QUESTIONS = '\n\n    Вопросы:\n    '
+PROMPT_BATCH_TAIL = PROMPT_TAIL + '''
+
+    Вопросов несколько: верни JSON с полем answers — массивом объектов с полями method и params,
+    по одному на каждый вопрос в том же порядке.'''
+
+# JSON-схема ответа модели: Ollama ограничивает генерацию этой схемой
+RESPONSE_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'method': {
+            'type': 'string',
+            'enum': list(AVAILABLE_METHODS)
+        },
+        'params': {
+            'type': 'object',
+            'properties': {
+                'creator_id': {'type': 'string'},
+                'date_range': {'type': 'string'},
+                'views_threshold': {'type': 'integer'},
+                'date': {'type': 'string'}
+            }
+        }
+    },
+    'required': ['method', 'params']
+}
+
+BATCH_RESPONSE_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'answers': {'type': 'array', 'items': RESPONSE_SCHEMA}
+    },
+    'required': ['answers']
+}
+
+# Строка копируется только если по краям действительно есть пробелы
+def maybe_strip(value):
+    if isinstance(value, str) and value and (value[0].isspace() or value[-1].isspace()):
+        return value.strip()
+    return value
+
+# Потокобезопасный LRU-кэш с ограничением времени жизни записей
+class QueryCache:
+    def __init__(self, max_size=512, ttl=600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            value, expires_at = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    # Проверка наличия без учёта в статистике попаданий и без изменения порядка LRU
+    def __contains__(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            return item is not None and item[1] >= time.monotonic()
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
 
 class VideoAnalytics:
-    def __init__(self, db_path='video_data.db', chroma_path='./chroma_db'):
+    # Фиксированный набор атрибутов экземпляра вместо __dict__
+    __slots__ = (
+        'db_path', 'chroma_path', 'use_vector_search', 'conn', 'db_lock',
+        'chroma_client', 'collection', 'collection_count', 'embedding_model', 'chroma_lock',
+        'model_cache', 'search_cache', 'dispatch', 'ollama_client'
+    )
+
+    MODEL_NAME = 'qwen2.5:7b-instruct-q4_K_M'
+    # Промпт с контекстом укладывается примерно в 1000 токенов
+    NUM_CTX = 2048
+    # Сколько модель остаётся загруженной в Ollama между вопросами
+    KEEP_ALIVE = '30m'
+    # Ответ модели — короткий JSON, длинная генерация только тратит время
+    MODEL_OPTIONS = {'num_predict': 200, 'num_ctx': NUM_CTX}
+    # num_ctx должен совпадать с рабочими запросами, иначе Ollama перезагрузит модель
+    WARMUP_OPTIONS = {'num_predict': 1, 'num_ctx': NUM_CTX}
+    # Больше вопросов в одном запросе не помещается в NUM_CTX вместе с контекстом и ответом
+    MAX_BATCH_SIZE = 5
+    # Первые три буквы однозначно задают месяц в любой форме: «ноября», «ноябрь», «нояб.»
+    MONTH_PREFIX = {
+        'янв': 1, 'фев': 2, 'мар': 3, 'апр': 4, 'май': 5, 'мая': 5,
+        'июн': 6, 'июл': 7, 'авг': 8, 'сен': 9, 'окт': 10, 'ноя': 11, 'дек': 12
+    }
+
+    def __init__(self, db_path=DB_NAME, chroma_path=CHROMA_PATH, use_vector_search=True, ollama_client=None):
         self.db_path = db_path
         self.chroma_path = chroma_path
-        self.chroma_client = chromadb.PersistentClient(path=chroma_path)
-        self.collection = self.chroma_client.get_collection(name='video_embeddings')
-
-    def query_sqlite(self, query, params=None):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        if params:
-            cursor.execute(query, params)
-        else:
-            cursor.execute(query)
-        result = cursor.fetchall()
-        conn.close()
-        return result
+        self.use_vector_search = use_vector_search
+        # Одно соединение на весь срок жизни объекта; запросы только на чтение,
+        # поэтому автокоммит, чтобы не держать открытые транзакции
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self.conn.executescript('''
+        PRAGMA journal_mode=WAL;
+        PRAGMA synchronous=NORMAL;
+        PRAGMA temp_store=MEMORY;
+        PRAGMA mmap_size=268435456;
+        PRAGMA cache_size=-65536;
+        ''')
+        self.db_lock = threading.Lock()
+        self.ensure_indexes()
+        # ChromaDB поднимается только при первом поиске по эмбеддингам:
+        # вопросы, разобранные route_question, её не используют
+        self.chroma_client = None
+        self.collection = None
+        self.collection_count = None
+        self.embedding_model = EMBEDDING_MODEL
+        self.chroma_lock = threading.Lock()
+        # Кэш ответов модели: вопрос -> ответ модели (JSON с методом и параметрами)
+        self.model_cache = QueryCache(max_size=512, ttl=600)
+        # Кэш результатов поиска по эмбеддингам: вопрос -> найденные документы
+        self.search_cache = QueryCache(max_size=512, ttl=3600)
+        # Метод -> (функция, разбор параметров из ответа модели в аргументы функции)
+        self.dispatch = {
+            'get_video_count': (self.get_video_count, None),
+            'get_videos_by_creator_in_date_range': (self.get_videos_by_creator_in_date_range, self.parse_creator_range_params),
+            'get_videos_with_views_more_than': (self.get_videos_with_views_more_than, self.parse_views_threshold_param),
+            'get_total_views_growth_on_date': (self.get_total_views_growth_on_date, self.parse_date_param),
+            'get_unique_videos_with_new_views_on_date': (self.get_unique_videos_with_new_views_on_date, self.parse_date_param)
+        }
+        # Один клиент Ollama с постоянным HTTP-соединением на все запросы.
+        # Пакеты ollama и chromadb импортируются при первом использовании:
+        # разбор вопросов без них работает
+        if ollama_client is None:
+            import ollama
+            ollama_client = ollama.Client()
+        self.ollama_client = ollama_client
+        self.warmup_model()
+
+    def ensure_indexes(self):
+        # База могла быть создана до появления индексов; CREATE INDEX IF NOT EXISTS идемпотентен
+        try:
+            with self.db_lock:
+                create_indexes(self.conn)
+        except sqlite3.Error as e:
+            logger.warning("Не удалось создать индексы в %s: %s", self.db_path, e)
+
+    def close(self):
+        with self.db_lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def warmup_model(self):
+        # Загружаем модель заранее, чтобы первый вопрос не ждал её загрузки
+        try:
+            self.ollama_client.generate(
+                model=self.MODEL_NAME,
+                prompt=' ',
+                options=self.WARMUP_OPTIONS,
+                keep_alive=self.KEEP_ALIVE
+            )
+        except Exception as e:
+            logger.warning("Не удалось загрузить модель %s: %s", self.MODEL_NAME, e)
+
+    def query_sqlite(self, query, params=()):
+        with self.db_lock:
+            return self.conn.execute(query, params).fetchall()
+
+    def query_scalar(self, query, params=()):
+        with self.db_lock:
+            return self.conn.execute(query, params).fetchone()[0]
 
     def parse_date(self, date_str):
-        month_map = {
-            'января': 1, 'февраля': 2, 'марта': 3, 'апреля': 4,
-            'мая': 5, 'июня': 6, 'июля': 7, 'августа': 8,
-            'сентября': 9, 'октября': 10, 'ноября': 11, 'декабря': 12
-        }
+        date_str = maybe_strip(date_str)
+        try:
+            # 2025-11-28 (в том числе с временем после даты: 2025-11-28T10:00, 2025-11-28 10:00)
+            if len(date_str) >= 10 and date_str[4] == '-' and date_str[7] == '-':
+                rest = date_str[10:]
+                if rest and not (rest[0] in 'T ' and rest[3:4] == ':'):
+                    return None
+                return datetime(int(date_str[:4]), int(date_str[5:7]), int(date_str[8:10]))
 
-        parts = date_str.split()
-        if len(parts) == 3:
-            day = int(parts[0])
-            month = month_map.get(parts[1].lower())
-            year = int(parts[2])
-            if month:
-                return datetime(year, month, day)
+            # 28.11.2025
+            parts = date_str.split('.')
+            if len(parts) == 3 and all(part.isdigit() for part in parts):
+                return datetime(int(parts[2]), int(parts[1]), int(parts[0]))
+
+            # 28 ноября 2025, в том числе со словами вокруг («28 ноября 2025 г.», «..., включительно»).
+            # Слова с цифрами, кроме самой даты, не допускаются: вторая дата означает диапазон
+            parts = date_str.replace('.', ' ').replace(',', ' ').split()
+            if sum(1 for part in parts if any(char.isdigit() for char in part)) != 2:
+                return None
+            for i in range(1, len(parts) - 1):
+                month = self.MONTH_PREFIX.get(parts[i][:3].lower())
+                if month and parts[i - 1].isdigit() and parts[i + 1].isdigit() and len(parts[i + 1]) == 4:
+                    return datetime(int(parts[i + 1]), month, int(parts[i - 1]))
+        except ValueError:
+            pass
         return None
 
     def parse_date_range(self, date_range_str):
-        if 'с' in date_range_str and 'по' in date_range_str:
-            parts = re.split(r' с | по ', date_range_str)
-            if len(parts) == 3:
-                start_date = self.parse_date(parts[1])
-                end_date = self.parse_date(parts[2])
-                if start_date and end_date:
-                    return start_date, end_date
-        elif 'по' in date_range_str:
-            parts = date_range_str.split(' по ')
-            if len(parts) == 2:
-                date = self.parse_date(parts[1])
-                if date:
-                    return date, date
-        else:
+        parts = DATE_RANGE_SPLIT_RE.split(date_range_str)
+        if len(parts) == 3 and not parts[0].strip():
+            # «с A по B», «от A до B»
+            start_date = self.parse_date(parts[1])
+            end_date = self.parse_date(parts[2])
+            if start_date and end_date:
+                return start_date, end_date
+        elif len(parts) == 2:
+            # «A по B», «A - B» — диапазон, «по B» — одна дата
+            end_date = self.parse_date(parts[1])
+            start_date = self.parse_date(parts[0]) if parts[0] else end_date
+            if start_date and end_date:
+                return start_date, end_date
+        elif len(parts) == 1:
             date = self.parse_date(date_range_str)
             if date:
                 return date, date
         return None, None
 
+    # Разбор параметров из ответа модели: кортеж аргументов метода или None, если параметры некорректны
+    def parse_creator_range_params(self, params):
+        creator_id = maybe_strip(params.get('creator_id'))
+        date_range = params.get('date_range')
+        # Значения другого типа от модели (число, список) считаются некорректными
+        if isinstance(creator_id, str) and isinstance(date_range, str) and creator_id and date_range:
+            start_date, end_date = self.parse_date_range(date_range)
+            if start_date and end_date:
+                return creator_id, start_date, end_date
+        return None
+
+    def parse_views_threshold_param(self, params):
+        views_threshold = params.get('views_threshold')
+        if views_threshold is not None:
+            try:
+                return (int(views_threshold),)
+            except (TypeError, ValueError):
+                pass
+        return None
+
+    def parse_date_param(self, params):
+        date_str = params.get('date')
+        if isinstance(date_str, str) and date_str:
+            date = self.parse_date(date_str)
+            if date:
+                return (date,)
+        return None
+
+    @staticmethod
+    def to_date_str(date):
+        # YYYY-MM-DD без времени: границы диапазонов в запросах к текстовым ISO-меткам
+        return f"{date.year:04d}-{date.month:02d}-{date.day:02d}"
+
     def get_video_count(self):
         query = "SELECT COUNT(*) FROM videos"
-        result = self.query_sqlite(query)
-        return result[0][0]
+        return self.query_scalar(query)
 
     def get_videos_by_creator_in_date_range(self, creator_id, start_date, end_date):
         query = """
         SELECT COUNT(*)
         FROM videos
-        WHERE creator_id = ? AND video_created_at BETWEEN ? AND ?
+        WHERE creator_id = ? AND video_created_at >= ? AND video_created_at < ?
         """
-        params = (creator_id, start_date.isoformat(), end_date.isoformat())
-        result = self.query_sqlite(query, params)
-        return result[0][0]
+        # Конечная дата включается целиком
+        params = (creator_id, self.to_date_str(start_date), self.to_date_str(end_date + timedelta(days=1)))
+        return self.query_scalar(query, params)
 
     def get_videos_with_views_more_than(self, views_threshold):
         query = "SELECT COUNT(*) FROM videos WHERE views_count > ?"
         params = (views_threshold,)
-        result = self.query_sqlite(query, params)
-        return result[0][0]
+        return self.query_scalar(query, params)
 
     def get_total_views_growth_on_date(self, date):
         query = """
         SELECT SUM(delta_views_count)
         FROM video_snapshots
-        WHERE created_at LIKE ?
+        WHERE created_at >= ? AND created_at < ?
         """
-        params = (f"%{date.year}-{date.month:02d}-{date.day:02d}%",)
-        result = self.query_sqlite(query, params)
-        return result[0][0] or 0
+        params = (self.to_date_str(date), self.to_date_str(date + timedelta(days=1)))
+        return self.query_scalar(query, params) or 0
 
     def get_unique_videos_with_new_views_on_date(self, date):
         query = """
         SELECT COUNT(DISTINCT video_id)
         FROM video_snapshots
-        WHERE created_at LIKE ? AND delta_views_count > 0
+        WHERE created_at >= ? AND created_at < ? AND delta_views_count > 0
         """
-        params = (f"%{date.year}-{date.month:02d}-{date.day:02d}%",)
-        result = self.query_sqlite(query, params)
-        return result[0][0]
+        params = (self.to_date_str(date), self.to_date_str(date + timedelta(days=1)))
+        return self.query_scalar(query, params)
+
+    # Коллекция эмбеддингов или None, если поиск по ней недоступен
+    def get_collection(self):
+        with self.chroma_lock:
+            if self.collection is None and self.use_vector_search:
+                import chromadb
+                from chromadb.errors import ChromaError
+                self.chroma_client = chromadb.PersistentClient(path=self.chroma_path)
+                try:
+                    self.collection = self.chroma_client.get_collection(name=COLLECTION_NAME)
+                except (ValueError, ChromaError) as e:
+                    logger.warning(
+                        "Коллекция %s не найдена (%s), вопросы обрабатываются без контекста; "
+                        "постройте её запуском json_to_base.py", COLLECTION_NAME, e
+                    )
+                    self.use_vector_search = False
+                    return None
+                self.check_embedding_model()
+            return self.collection if self.use_vector_search else None
+
+    def check_embedding_model(self):
+        # Вопрос нужно векторизовать той же моделью, что и документы коллекции,
+        # иначе не совпадёт размерность или пространство эмбеддингов
+        stored_model = (self.collection.metadata or {}).get('embedding_model')
+        if stored_model is None:
+            # Коллекции без метаданных строились старым загрузчиком через /api/embeddings:
+            # их векторы не нормализованы и несравнимы с векторами вопросов из /api/embed
+            logger.warning(
+                "Коллекция %s построена старой версией json_to_base.py, вопросы обрабатываются "
+                "без контекста; перестройте её запуском json_to_base.py", COLLECTION_NAME
+            )
+            self.use_vector_search = False
+        elif stored_model != self.embedding_model:
+            logger.warning(
+                "Коллекция %s построена моделью %s, а не %s; запросы будут векторизоваться ей",
+                COLLECTION_NAME, stored_model, self.embedding_model
+            )
+            self.embedding_model = stored_model
+
+    def get_collection_count(self):
+        collection = self.get_collection()
+        if collection is None:
+            return 0
+        with self.chroma_lock:
+            if self.collection_count is None:
+                self.collection_count = collection.count()
+            return self.collection_count
+
+    def invalidate_count(self):
+        # Вызывать после записи в коллекцию
+        with self.chroma_lock:
+            self.collection_count = None
 
     def search_in_embeddings(self, query_text, n_results=3):
-        results = self.collection.query(
-            query_texts=[query_text],
-            n_results=n_results
-        )
+        # Коллекция в этом процессе только читается, поэтому результаты поиска можно кэшировать
+        cache_key = (self.normalize_question(query_text), n_results)
+        results = self.search_cache.get(cache_key)
+        if results is None:
+            max_results = min(n_results, self.get_collection_count())
+            if max_results == 0:
+                return {'documents': [[]]}
+            # /api/embed возвращает векторы единичной длины; json_to_base.py строит коллекцию
+            # тем же эндпоинтом (коллекции старого формата отключаются в check_embedding_model)
+            query_embedding = self.ollama_client.embed(
+                model=self.embedding_model,
+                input=query_text,
+                keep_alive=self.KEEP_ALIVE
+            )['embeddings'][0]
+            results = self.get_collection().query(
+                query_embeddings=[query_embedding],
+                n_results=max_results
+            )
+            self.search_cache.set(cache_key, results)
         return results
 
-    def process_question(self, question):
-        # Шаг 1: Используем эмбеддинги для поиска релевантной информации
-        embedding_results = self.search_in_embeddings(question)
-        documents = embedding_results.get('documents', [[]])
+    @staticmethod
+    def normalize_question(question):
+        return ' '.join(question.lower().split())
+
+    def ask_model(self, question):
+        # Повторные вопросы отвечаются из кэша без обращения к эмбеддингам и модели
+        cache_key = self.normalize_question(question)
+        message_content = self.model_cache.get(cache_key)
+        if message_content is None:
+            message_content = self._ask_model_uncached(question)
+            # Непригодный ответ не кэшируется: при повторе вопрос снова уйдёт модели
+            if self.is_usable_response(message_content):
+                self.model_cache.set(cache_key, message_content)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "Кэш ответов модели: попаданий %d, промахов %d (%.0f%%)",
+                self.model_cache.hits, self.model_cache.misses, self.model_cache.hit_rate * 100
+            )
+        return message_content
+
+    def get_context_documents(self, question):
+        # Документы из эмбеддингов, релевантные вопросу
+        if not self.use_vector_search:
+            return []
+        documents = self.search_in_embeddings(question).get('documents', [[]])
         if not documents or not documents[0]:
-            context = ""
-        else:
-            context = "\n".join(str(doc) for doc in documents[0])
+            return []
+        return [str(doc) for doc in documents[0]]
+
+    def _ask_model_uncached(self, question):
+        # Шаг 1: Используем эмбеддинги для поиска релевантной информации
+        context = "\n".join(self.get_context_documents(question))
 
         # Шаг 2: Формируем запрос к модели с учётом контекста
-        prompt = f"""Контекст:
-    {context}
+        prompt = PROMPT_HEAD + context + PROMPT_QUESTION + question + PROMPT_TAIL
+        response = self.ollama_client.generate(
+            model=self.MODEL_NAME,
+            prompt=prompt,
+            options=self.MODEL_OPTIONS,
+            # Декодирование ограничено JSON-схемой: только известные методы и параметры
+            format=RESPONSE_SCHEMA,
+            keep_alive=self.KEEP_ALIVE,
+            stream=False
+        )
+        return response['response']
 
-    Вопрос: {question}
+    def ask_model_batch(self, questions):
+        # Один запрос к модели на несколько вопросов: общий контекст и инструкции
+        # обрабатываются моделью один раз. Пригодные ответы кладутся в кэш ответов модели
+        documents = []
+        for question in questions:
+            for doc in self.get_context_documents(question):
+                if doc not in documents:
+                    documents.append(doc)
+        numbered_questions = "\n    ".join(
+            f"{number}. {question}" for number, question in enumerate(questions, 1)
+        )
+        prompt = PROMPT_HEAD + "\n".join(documents) + PROMPT_BATCH_QUESTIONS + numbered_questions + PROMPT_BATCH_TAIL
+        options = dict(self.MODEL_OPTIONS, num_predict=self.MODEL_OPTIONS['num_predict'] * len(questions))
+        response = self.ollama_client.generate(
+            model=self.MODEL_NAME,
+            prompt=prompt,
+            options=options,
+            format=BATCH_RESPONSE_SCHEMA,
+            keep_alive=self.KEEP_ALIVE,
+            stream=False
+        )
+        answers = self.parse_model_response(response['response']).get('answers')
+        if not isinstance(answers, list) or len(answers) != len(questions):
+            raise ValueError("Number of answers does not match number of questions")
+        for question, answer in zip(questions, answers):
+            # Непригодные ответы не кэшируются: такие вопросы будут заданы модели по одному
+            if isinstance(answer, dict) and self.resolve_answer(answer) is not None:
+                self.model_cache.set(self.normalize_question(question), json.dumps(answer, ensure_ascii=False))
 
-    Инструкции:
-    1. Проанализируй вопрос и контекст.
-    2. Определи, какой метод нужно вызвать для получения ответа.
-    3. Извлеки необходимые параметры из вопроса.
-    4. Верни ответ в формате JSON с полями:
-    - method: название метода
-    - params: параметры для метода
-    - answer: ответ на вопрос (если можно вычислить сразу)
+    def route_question(self, question):
+        # Возвращает (имя метода, аргументы) для вопросов известного вида или None
+        question = question.strip()
+        match = CREATOR_RANGE_RE.fullmatch(question)
+        if match:
+            start_date = self.parse_date(match.group(2))
+            end_date = self.parse_date(match.group(3))
+            if start_date and end_date:
+                return 'get_videos_by_creator_in_date_range', (match.group(1), start_date, end_date)
 
-    Доступные методы:
-    1. get_video_count() - получить общее количество видео в системе
-    2. get_videos_by_creator_in_date_range(creator_id, start_date, end_date) - получить количество видео у креатора в диапазоне дат
-    3. get_videos_with_views_more_than(views_threshold) - получить количество видео с просмотрами больше указанного значения
-    4. get_total_views_growth_on_date(date) - получить суммарный рост просмотров за указанную дату
-    5. get_unique_videos_with_new_views_on_date(date) - получить количество уникальных видео с новыми просмотрами за указанную дату"""
+        match = VIEWS_MORE_THAN_RE.fullmatch(question)
+        if match:
+            return 'get_videos_with_views_more_than', (int(''.join(match.group(1).split())),)
+
+        match = VIEWS_GROWTH_RE.fullmatch(question)
+        if match:
+            date = self.parse_date(match.group(1))
+            if date:
+                return 'get_total_views_growth_on_date', (date,)
+
+        match = NEW_VIEWS_RE.fullmatch(question)
+        if match:
+            date = self.parse_date(match.group(1))
+            if date:
+                return 'get_unique_videos_with_new_views_on_date', (date,)
+
+        if VIDEO_COUNT_RE.fullmatch(question):
+            return 'get_video_count', ()
+
+        return None
+
+    def parse_model_response(self, message_content):
+        # Обычно ответ — чистый JSON; поиск объекта в тексте нужен только в остальных случаях
         try:
-            response = ollama.chat(
-                model='qwen3-vl:8b-instruct-q8_0',
-                messages=[{
-                    'role': 'user',
-                    'content': prompt,
-                    'images': []
-                }]
-            )
+            answer_data = json.loads(message_content)
+        except json.JSONDecodeError:
+            match = JSON_OBJECT_RE.search(message_content)
+            if not match:
+                raise
+            answer_data = json.loads(match.group(0))
+        if not isinstance(answer_data, dict):
+            raise ValueError("Answer is not a dictionary")
+        return answer_data
+
+    def resolve_answer(self, answer_data):
+        # (функция, аргументы) для ответа модели или None, если метод или параметры некорректны
+        method = maybe_strip(answer_data.get('method'))
+        if not isinstance(method, str) or method not in self.dispatch:
+            return None
+        func, parse_params = self.dispatch[method]
+        params = answer_data.get('params') or {}
+        if not isinstance(params, dict):
+            return None
+        args = parse_params(params) if parse_params else ()
+        if args is None:
+            return None
+        return func, args
+
+    def is_usable_response(self, message_content):
+        try:
+            return self.resolve_answer(self.parse_model_response(message_content)) is not None
+        except ValueError:
+            return False
+
+    def process_question(self, question):
+        return self.answer_question(question, self.route_question(question))
+
+    def answer_question(self, question, routed):
+        # routed — результат route_question для этого вопроса
+        try:
+            # Известные вопросы разбираем сами, модель нужна только для остальных
+            if routed:
+                method, args = routed
+                return str(self.dispatch[method][0](*args))
 
             # Обрабатываем ответ от модели
-            message_content = response['message']['content']
+            message_content = self.ask_model(question)
 
             try:
-                # Пробуем разобрать как JSON
-                answer_data = json.loads(message_content)
-                if not isinstance(answer_data, dict):
-                    raise ValueError("Answer is not a dictionary")
-
-                method = answer_data.get('method')
-                params = answer_data.get('params', {})
-                direct_answer = answer_data.get('answer')
-
-                if direct_answer is not None:
-                    return str(direct_answer)
-
-                if method == 'get_video_count':
-                    return str(self.get_video_count())
-                elif method == 'get_videos_by_creator_in_date_range':
-                    creator_id = params.get('creator_id')
-                    date_range = params.get('date_range')
-                    if creator_id and date_range:
-                        start_date, end_date = self.parse_date_range(date_range)
-                        if start_date and end_date:
-                            return str(self.get_videos_by_creator_in_date_range(creator_id, start_date, end_date))
-                elif method == 'get_videos_with_views_more_than':
-                    views_threshold = params.get('views_threshold')
-                    if views_threshold is not None:
-                        return str(self.get_videos_with_views_more_than(views_threshold))
-                elif method == 'get_total_views_growth_on_date':
-                    date_str = params.get('date')
-                    if date_str:
-                        date = self.parse_date(date_str)
-                        if date:
-                            return str(self.get_total_views_growth_on_date(date))
-                elif method == 'get_unique_videos_with_new_views_on_date':
-                    date_str = params.get('date')
-                    if date_str:
-                        date = self.parse_date(date_str)
-                        if date:
-                            return str(self.get_unique_videos_with_new_views_on_date(date))
+                resolved = self.resolve_answer(self.parse_model_response(message_content))
+                if resolved:
+                    func, args = resolved
+                    return str(func(*args))
 
                 return "Извините, не удалось определить метод для ответа на вопрос."
 
-            except (json.JSONDecodeError, ValueError) as e:
-                # Если ответ не в формате JSON или не словарь, пробуем извлечь число напрямую
-                numbers = re.findall(r'\d+', message_content)
-                if numbers:
-                    return numbers[0]
-                return "Извините, не удалось извлечь числовой ответ из ответа модели."
+            except (json.JSONDecodeError, ValueError):
+                return "Извините, не удалось разобрать ответ модели."
 
         except Exception as e:
-            print(f"Ошибка при обработке ответа: {e}")
+            logger.exception("Ошибка при обработке ответа: %s", e)
             return "Извините, произошла ошибка при обработке вашего вопроса."
 
+    def process_questions(self, questions):
+        # Вопросы, которым нужна модель, отправляются ей пакетами; после этого каждый вопрос
+        # проходит обычный путь и берёт ответ модели из кэша. Если пакетный запрос не удался,
+        # answer_question спросит модель по каждому вопросу отдельно
+        routes = [self.route_question(question) for question in questions]
+        pending = {}
+        for question, routed in zip(questions, routes):
+            cache_key = self.normalize_question(question)
+            if routed or cache_key in pending or cache_key in self.model_cache:
+                continue
+            pending[cache_key] = question
+
+        pending_questions = list(pending.values())
+        for start in range(0, len(pending_questions), self.MAX_BATCH_SIZE):
+            batch = pending_questions[start:start + self.MAX_BATCH_SIZE]
+            if len(batch) < 2:
+                continue
+            try:
+                self.ask_model_batch(batch)
+            except Exception as e:
+                logger.warning("Пакетный запрос к модели не удался, вопросы будут заданы по одному: %s", e)
+
+        return [self.answer_question(question, routed) for question, routed in zip(questions, routes)]
+
+    def process_questions_parallel(self, questions, max_workers=4):
+        # Вопросы от разных пользователей обрабатываются одновременно; чтобы Ollama
+        # действительно выполняла их параллельно, сервер запускается с
+        # OLLAMA_NUM_PARALLEL не меньше max_workers
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(self.process_question, questions))
+
 def main():
-    analytics = VideoAnalytics()
+    listener = setup_logging()
 
     print("Добро пожаловать в систему анализа видео!")
     print("Вы можете задавать вопросы на русском языке, например:")
@@ -216,13 +709,17 @@ def main():
     print("- Сколько разных видео получали новые просмотры 27 ноября 2025?")
     print("Для выхода введите 'exit'")
 
-    while True:
-        question = input("\nВаш вопрос: ")
-        if question.lower() == 'exit':
-            break
+    try:
+        with VideoAnalytics() as analytics:
+            while True:
+                question = input("\nВаш вопрос: ")
+                if question.lower() == 'exit':
+                    break
 
-        answer = analytics.process_question(question)
-        print(f"Ответ: {answer}")
+                answer = analytics.process_question(question)
+                print(f"Ответ: {answer}")
+    finally:
+        listener.stop()
 
 if __name__ == "__main__":
     main()
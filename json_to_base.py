@@ -1,125 +1,242 @@
 # json_to_base.py
 
-import json
+import hashlib
+import os
 import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 from datetime import datetime
+from operator import itemgetter
 import chromadb
+from chromadb.errors import ChromaError
+import ijson
+import numpy as np
 import ollama
+import orjson
+from storage import DB_NAME, CHROMA_PATH, COLLECTION_NAME, EMBEDDING_MODEL, create_indexes
 
-# Чтение JSON-файла
-def read_json_file(file_path):
-    with open(file_path, 'r', encoding='utf-8') as file:
-        data = json.load(file)
-    return data
+# Файлы до этого размера читаются целиком, более крупные — потоково
+FULL_LOAD_MAX_BYTES = 64 * 1024 * 1024
+# Сколько текстов отправлять в Ollama за один запрос эмбеддингов
+EMBED_BATCH_SIZE = int(os.environ.get('OLLAMA_EMBED_BATCH', '32'))
+# Сколько записей добавлять в коллекцию ChromaDB за один вызов add
+CHROMA_ADD_BATCH_SIZE = 100
+
+# Поля записей JSON в порядке столбцов таблиц (created_at/updated_at видео и
+# updated_at снапшота необязательны и добавляются отдельно)
+VIDEO_FIELDS = itemgetter(
+    'id', 'creator_id', 'video_created_at',
+    'views_count', 'likes_count', 'comments_count', 'reports_count'
+)
+SNAPSHOT_COUNT_FIELDS = itemgetter(
+    'views_count', 'likes_count', 'comments_count', 'reports_count',
+    'delta_views_count', 'delta_likes_count', 'delta_comments_count', 'delta_reports_count',
+    'created_at'
+)
+
+# Чтение видео из JSON-файла. Небольшой файл быстрее разобрать целиком через orjson;
+# большой читается потоково через ijson, и видео (вместе со снапшотами) разбираются по одному
+def iter_videos(file_path):
+    if os.path.getsize(file_path) <= FULL_LOAD_MAX_BYTES:
+        with open(file_path, 'rb') as file:
+            data = orjson.loads(file.read())
+        yield from data['videos']
+        return
+
+    with open(file_path, 'rb') as file:
+        yield from ijson.items(file, 'videos.item')
+
+# Удаление файла базы вместе с её журналами, если они есть
+def remove_database_files(db_name):
+    for path in (db_name, db_name + '-journal', db_name + '-wal', db_name + '-shm'):
+        if os.path.exists(path):
+            os.remove(path)
+
+# Подготовка рабочей базы к замене файла: база переводится из WAL в обычный журнал,
+# чтобы её файлы -wal/-shm были удалены и не применились к новой базе после замены.
+# Уже запущенный бот продолжает читать прежний файл до перезапуска
+def release_database(db_name):
+    if not os.path.exists(db_name):
+        return
+    try:
+        with closing(sqlite3.connect(db_name)) as conn:
+            journal_mode = conn.execute('PRAGMA journal_mode=DELETE').fetchone()[0]
+    except sqlite3.OperationalError as e:
+        # База заблокирована другим процессом — её журналы трогать нельзя
+        raise RuntimeError(
+            f"База {db_name} занята другим процессом; остановите бота и повторите загрузку"
+        ) from e
+    except sqlite3.DatabaseError:
+        # Повреждённая база заменяется целиком вместе с журналами
+        remove_database_files(db_name)
+        return
+    if journal_mode != 'delete':
+        raise RuntimeError(
+            f"База {db_name} открыта другим процессом; остановите бота и повторите загрузку"
+        )
 
 # Создание и заполнение базы данных SQLite
-def create_and_populate_database(data, db_name='video_data.db'):
-    # Подключение к базе данных
-    conn = sqlite3.connect(db_name)
-    cursor = conn.cursor()
-
-    # Создание таблицы videos
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS videos (
-        id TEXT PRIMARY KEY,
-        creator_id TEXT,
-        video_created_at TEXT,
-        views_count INTEGER,
-        likes_count INTEGER,
-        comments_count INTEGER,
-        reports_count INTEGER,
-        created_at TEXT,
-        updated_at TEXT
-    )
-    ''')
-
-    # Создание таблицы video_snapshots
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS video_snapshots (
-        id TEXT PRIMARY KEY,
-        video_id TEXT,
-        views_count INTEGER,
-        likes_count INTEGER,
-        comments_count INTEGER,
-        reports_count INTEGER,
-        delta_views_count INTEGER,
-        delta_likes_count INTEGER,
-        delta_comments_count INTEGER,
-        delta_reports_count INTEGER,
-        created_at TEXT,
-        updated_at TEXT,
-        FOREIGN KEY (video_id) REFERENCES videos (id)
-    )
-    ''')
+# Возвращает id и creator_id загруженных видео для построения эмбеддингов
+# и число загруженных снапшотов (считается по ходу вставки, без отдельного прохода)
+def create_and_populate_database(videos, db_name=DB_NAME):
+    # База строится во временном файле и заменяет рабочую только после фиксации транзакции.
+    # Если загрузка прервется (исключение, завершение процесса, сбой ОС), временный файл
+    # может остаться поврежденным, но рабочая база не затрагивается, а временный файл
+    # удаляется при следующем запуске
+    tmp_name = db_name + '.loading'
+    remove_database_files(tmp_name)
+    try:
+        result = populate_database(videos, tmp_name)
+        # Данные записывались без fsync: сбрасываем файл на диск до замены рабочей базы
+        with open(tmp_name, 'rb+') as file:
+            os.fsync(file.fileno())
+        release_database(db_name)
+        os.replace(tmp_name, db_name)
+    except BaseException:
+        remove_database_files(tmp_name)
+        raise
+    return result
 
-    # Заполнение таблицы videos
-    for video in data['videos']:
+# Заполнение новой базы данных из итератора видео
+def populate_database(videos, db_name):
+    # Подключение к базе данных: соединение закрывается и при ошибке,
+    # изменения фиксируются при успешном выходе из блока и откатываются при исключении
+    with closing(sqlite3.connect(db_name)) as conn, conn:
+        # Настройки соединения на время загрузки, до любых DDL и вставок. Файл новый и при
+        # сбое просто удаляется, поэтому fsync и журнал отката на диске не нужны;
+        # память — под кэш страниц и сортировки индексов
+        conn.executescript('''
+        PRAGMA synchronous=OFF;
+        PRAGMA journal_mode=MEMORY;
+        PRAGMA temp_store=MEMORY;
+        PRAGMA cache_size=-200000;
+        ''')
+        cursor = conn.cursor()
+        # Вся загрузка, включая DDL, — одна транзакция с блокировкой записи с самого начала
+        cursor.execute('BEGIN IMMEDIATE')
+
+        # Создание таблицы videos
         cursor.execute('''
-        INSERT OR REPLACE INTO videos (id, creator_id, video_created_at, views_count, likes_count, comments_count, reports_count, created_at, updated_at)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            video['id'],
-            video['creator_id'],
-            video['video_created_at'],
-            video['views_count'],
-            video['likes_count'],
-            video['comments_count'],
-            video['reports_count'],
-            video.get('created_at', datetime.now().isoformat()),
-            video.get('updated_at', datetime.now().isoformat())
-        ))
-
-    # Заполнение таблицы video_snapshots
-    for video in data['videos']:
-        for snapshot in video.get('snapshots', []):
-            cursor.execute('''
+        CREATE TABLE IF NOT EXISTS videos (
+            id TEXT PRIMARY KEY,
+            creator_id TEXT,
+            video_created_at TEXT,
+            views_count INTEGER,
+            likes_count INTEGER,
+            comments_count INTEGER,
+            reports_count INTEGER,
+            created_at TEXT,
+            updated_at TEXT
+        )
+        ''')
+
+        # Создание таблицы video_snapshots
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS video_snapshots (
+            id TEXT PRIMARY KEY,
+            video_id TEXT,
+            views_count INTEGER,
+            likes_count INTEGER,
+            comments_count INTEGER,
+            reports_count INTEGER,
+            delta_views_count INTEGER,
+            delta_likes_count INTEGER,
+            delta_comments_count INTEGER,
+            delta_reports_count INTEGER,
+            created_at TEXT,
+            updated_at TEXT,
+            FOREIGN KEY (video_id) REFERENCES videos (id)
+        )
+        ''')
+
+        # Заполнение таблиц за один проход по видео: снапшоты каждого видео
+        # вставляются сразу, строки videos копятся (их на порядки меньше)
+        # Значение по умолчанию для отсутствующих created_at/updated_at вычисляется один раз
+        current_time = datetime.now().isoformat()
+        video_rows = []
+        loaded_videos = []
+        snapshot_count = 0
+        for video in videos:
+            video_id = video['id']
+            video_rows.append(VIDEO_FIELDS(video) + (
+                video.get('created_at', current_time),
+                video.get('updated_at', current_time)
+            ))
+            loaded_videos.append({'id': video_id, 'creator_id': video['creator_id']})
+
+            cursor.executemany('''
             INSERT OR REPLACE INTO video_snapshots (
                 id, video_id, views_count, likes_count, comments_count, reports_count,
                 delta_views_count, delta_likes_count, delta_comments_count, delta_reports_count,
                 created_at, updated_at
             )
             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                snapshot['id'],
-                video['id'],
-                snapshot['views_count'],
-                snapshot['likes_count'],
-                snapshot['comments_count'],
-                snapshot['reports_count'],
-                snapshot['delta_views_count'],
-                snapshot['delta_likes_count'],
-                snapshot['delta_comments_count'],
-                snapshot['delta_reports_count'],
-                snapshot['created_at'],
-                snapshot.get('updated_at', datetime.now().isoformat())
-            ))
+            ''', [
+                (snapshot['id'], video_id)
+                + SNAPSHOT_COUNT_FIELDS(snapshot)
+                + (snapshot.get('updated_at', current_time),)
+                for snapshot in video.get('snapshots', [])
+            ])
+            snapshot_count += cursor.rowcount
 
-    # Сохранение изменений и закрытие соединения
-    conn.commit()
-    conn.close()
+        cursor.executemany('''
+        INSERT OR REPLACE INTO videos (id, creator_id, video_created_at, views_count, likes_count, comments_count, reports_count, created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', video_rows)
 
-# Функция для генерации эмбеддингов с использованием Ollama
-def generate_embeddings(texts, model='nomic-embed-text-v2-moe'):
+        # Индексы строятся одним проходом по уже загруженным данным,
+        # а не обновляются при вставке каждой строки
+        create_indexes(cursor)
+
+    return loaded_videos, snapshot_count
+
+# Функция для генерации эмбеддингов с использованием Ollama: тексты отправляются
+# пачками через /api/embed, а не по одному HTTP-запросу на текст.
+# Результат — одна матрица float32 формы (число текстов, размерность)
+def generate_embeddings(texts, model=EMBEDDING_MODEL, batch_size=EMBED_BATCH_SIZE):
     embeddings = []
-    for text in texts:
-        response = ollama.embeddings(model=model, prompt=text)
-        embeddings.append(response['embedding'])
-    return embeddings
+    for start in range(0, len(texts), batch_size):
+        response = ollama.embed(model=model, input=texts[start:start + batch_size])
+        embeddings.extend(response['embeddings'])
+    return np.asarray(embeddings, dtype=np.float32)
+
+# Эмбеддинги для пачки документов одной матрицей float32: неизменившиеся документы
+# берут вектор из known (id -> (документ, эмбеддинг)), в Ollama отправляются только остальные
+def embed_documents(ids, documents, known):
+    embeddings = [None] * len(documents)
+    missing = []
+    for index, (video_id, document) in enumerate(zip(ids, documents)):
+        cached = known.get(video_id)
+        if cached is not None and cached[0] == document:
+            embeddings[index] = cached[1]
+        else:
+            missing.append(index)
+    if missing:
+        generated = generate_embeddings([documents[index] for index in missing])
+        for index, embedding in zip(missing, generated):
+            embeddings[index] = embedding
+    return np.asarray(embeddings, dtype=np.float32)
+
+# Хэш содержимого коллекции: по нему повторный запуск на тех же данных
+# не пересчитывает эмбеддинги и не перестраивает индекс
+def content_hash(documents):
+    digest = hashlib.blake2b()
+    for document in documents:
+        digest.update(document.encode())
+        digest.update(b'\n')
+    return digest.hexdigest()
 
 # Создание базы эмбеддингов в ChromaDB
-def create_embedding_database(data, collection_name='video_embeddings'):
+def create_embedding_database(videos, collection_name=COLLECTION_NAME):
     # Инициализация ChromaDB
-    client = chromadb.PersistentClient(path="./chroma_db")
-
-    # Создание коллекции
-    collection = client.get_or_create_collection(name=collection_name)
+    client = chromadb.PersistentClient(path=CHROMA_PATH)
 
     # Подготовка данных для ChromaDB
     documents = []
     metadatas = []
     ids = []
 
-    for video in data['videos']:
+    for video in videos:
         # Создаем текстовое описание для каждого видео
         text = f"Video ID: {video['id']}, Creator ID: {video['creator_id']}"
         documents.append(text)
@@ -129,31 +246,77 @@ def create_embedding_database(data, collection_name='video_embeddings'):
         })
         ids.append(video['id'])
 
-    # Генерация эмбеддингов с помощью Ollama
-    embeddings = generate_embeddings(documents)
+    # Модель эмбеддингов сохраняется в метаданных, чтобы запросы строились той же моделью,
+    # хэш содержимого — чтобы не перестраивать коллекцию без изменений в данных
+    collection_metadata = {
+        'embedding_model': EMBEDDING_MODEL,
+        'content_hash': content_hash(documents)
+    }
+    # Метаданные существующей коллекции читаются без изменения: в части версий chromadb
+    # get_or_create_collection перезаписывает их переданными
+    try:
+        collection = client.get_collection(name=collection_name)
+    except (ValueError, ChromaError):
+        collection = None
+
+    known = {}
+    if collection is not None:
+        existing_metadata = collection.metadata or {}
+        existing_count = collection.count()
+        if existing_metadata == collection_metadata and existing_count == len(ids):
+            # Данные и модель не менялись — коллекция уже актуальна
+            return collection
+
+        # Данные изменились (или прошлая загрузка не завершилась) — коллекция создается заново.
+        # Эмбеддинги той же модели для неизменившихся документов сохраняются и не пересчитываются
+        if existing_count and existing_metadata.get('embedding_model') == EMBEDDING_MODEL:
+            existing = collection.get(ids=ids, include=['documents', 'embeddings'])
+            known = {
+                video_id: (document, embedding)
+                for video_id, document, embedding in zip(
+                    existing['ids'], existing['documents'], existing['embeddings']
+                )
+            }
+        client.delete_collection(name=collection_name)
 
-    # Добавление в коллекцию
-    collection.add(
-        embeddings=embeddings,
-        documents=documents,
-        metadatas=metadatas,
-        ids=ids
+    collection = client.create_collection(
+        name=collection_name,
+        metadata=collection_metadata
     )
 
+    # Генерация эмбеддингов с помощью Ollama и добавление в коллекцию пачками, не больше
+    # допустимого клиентом размера. Запись пачки в ChromaDB идет в отдельном потоке,
+    # пока Ollama считает эмбеддинги следующей
+    batch_size = min(CHROMA_ADD_BATCH_SIZE, client.get_max_batch_size())
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        pending = None
+        for start in range(0, len(ids), batch_size):
+            end = start + batch_size
+            embeddings = embed_documents(ids[start:end], documents[start:end], known)
+            if pending is not None:
+                pending.result()
+            pending = executor.submit(
+                collection.add,
+                embeddings=embeddings,
+                documents=documents[start:end],
+                metadatas=metadatas[start:end],
+                ids=ids[start:end]
+            )
+        if pending is not None:
+            pending.result()
+
     return collection
 
 def main():
     # Путь к JSON-файлу
     json_file_path = 'tester.json'  # Замени на реальный путь к файлу
 
-    # Чтение данных
-    data = read_json_file(json_file_path)
-
-    # Создание и заполнение базы данных SQLite
-    create_and_populate_database(data)
+    # Создание и заполнение базы данных SQLite по мере чтения файла
+    videos, snapshot_count = create_and_populate_database(iter_videos(json_file_path))
+    print(f"Loaded {len(videos)} videos with {snapshot_count} snapshots.")
 
     # Создание базы эмбеддингов
-    collection = create_embedding_database(data)
+    collection = create_embedding_database(videos)
     print(f"Embedding collection created with {collection.count()} entries.")
 
 if __name__ == "__main__":
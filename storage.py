@@ -0,0 +1,33 @@
+# storage.py
+
+# Общие настройки хранилищ и схема индексов SQLite для загрузчика (json_to_base.py)
+# и бота (gen_model.py). Модуль без внешних зависимостей: бот не должен требовать
+# пакетов, нужных только загрузчику
+DB_NAME = 'video_data.db'
+CHROMA_PATH = './chroma_db'
+COLLECTION_NAME = 'video_embeddings'
+EMBEDDING_MODEL = 'nomic-embed-text-v2-moe'
+
+# Индексы под аналитические запросы VideoAnalytics
+def create_indexes(cursor):
+    # Видео креатора за период
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_videos_creator_created
+    ON videos (creator_id, video_created_at)
+    ''')
+    # Видео с просмотрами больше порога
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_videos_views
+    ON videos (views_count)
+    ''')
+    # Суммарный рост просмотров за дату (покрывающий индекс)
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_snapshots_created
+    ON video_snapshots (created_at, delta_views_count)
+    ''')
+    # Видео, получавшие новые просмотры за дату
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_snapshots_created_new_views
+    ON video_snapshots (created_at, video_id)
+    WHERE delta_views_count > 0
+    ''')
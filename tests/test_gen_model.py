@@ -0,0 +1,177 @@
+# tests/test_gen_model.py
+
+import json
+from datetime import datetime
+
+import pytest
+
+from gen_model import VideoAnalytics
+
+
+@pytest.fixture
+def analytics():
+    # Разбор вопросов не использует базу, модель и ChromaDB — __init__ не вызывается
+    return object.__new__(VideoAnalytics)
+
+
+# Клиент Ollama, который возвращает заранее заданные ответы модели по очереди
+class FakeOllamaClient:
+    def __init__(self, *replies):
+        self.replies = list(replies)
+        self.calls = 0
+
+    def generate(self, **kwargs):
+        # Прогрев модели при создании VideoAnalytics не расходует ответы
+        if 'format' not in kwargs:
+            return {'response': ''}
+        self.calls += 1
+        reply = self.replies.pop(0)
+        return {'response': reply if isinstance(reply, str) else json.dumps(reply)}
+
+
+VIDEO_COUNT_ANSWER = {'method': 'get_video_count', 'params': {}}
+BAD_CREATOR_ANSWER = {'method': 'get_videos_by_creator_in_date_range', 'params': {}}
+
+
+def make_analytics(*replies):
+    analytics = VideoAnalytics(
+        db_path=':memory:',
+        use_vector_search=False,
+        ollama_client=FakeOllamaClient(*replies)
+    )
+    analytics.conn.executescript('''
+    CREATE TABLE videos (id TEXT PRIMARY KEY);
+    INSERT INTO videos VALUES ('a'), ('b');
+    ''')
+    return analytics
+
+
+# Вопросы известного вида отвечаются без обращения к модели
+@pytest.mark.parametrize('question, expected', [
+    ('Сколько всего видео есть в системе?', ('get_video_count', ())),
+    (
+        'Сколько видео у креатора с id aca1061a9d324ecf8c3fa2bb32d7be63 вышло '
+        'с 1 ноября 2025 по 5 ноября 2025 включительно?',
+        (
+            'get_videos_by_creator_in_date_range',
+            ('aca1061a9d324ecf8c3fa2bb32d7be63', datetime(2025, 11, 1), datetime(2025, 11, 5))
+        )
+    ),
+    (
+        'Сколько видео набрало больше 100000 просмотров за всё время?',
+        ('get_videos_with_views_more_than', (100000,))
+    ),
+    (
+        'Сколько видео набрало больше 100 000 просмотров?',
+        ('get_videos_with_views_more_than', (100000,))
+    ),
+    (
+        'На сколько просмотров в сумме выросли все видео 28 ноября 2025?',
+        ('get_total_views_growth_on_date', (datetime(2025, 11, 28),))
+    ),
+    (
+        'Сколько разных видео получали новые просмотры 27 ноября 2025?',
+        ('get_unique_videos_with_new_views_on_date', (datetime(2025, 11, 27),))
+    ),
+])
+def test_route_known_questions(analytics, question, expected):
+    assert analytics.route_question(question) == expected
+
+
+# Вопросы с дополнительными условиями не разбираются шаблонами и уходят модели
+@pytest.mark.parametrize('question', [
+    'Сколько видео в системе набрали больше 5 лайков?',
+    'Сколько видео креатора с id aca1061a9d324ecf8c3fa2bb32d7be63 набрали больше 1000 просмотров?',
+    'Сколько видео набрали больше 10000 просмотров 28 ноября 2025?',
+    'Сколько всего видео есть в системе у креатора с id aca1061a9d324ecf8c3fa2bb32d7be63?',
+    'На сколько просмотров в сумме выросли все видео креатора с id abc 28 ноября 2025?',
+])
+def test_route_questions_with_extra_conditions(analytics, question):
+    assert analytics.route_question(question) is None
+
+
+@pytest.mark.parametrize('date_range, expected', [
+    ('с 1 ноября 2025 по 5 ноября 2025', (datetime(2025, 11, 1), datetime(2025, 11, 5))),
+    ('с 1 ноября 2025 по 5 ноября 2025 включительно', (datetime(2025, 11, 1), datetime(2025, 11, 5))),
+    ('с 1 ноября 2025 до 5 ноября 2025', (datetime(2025, 11, 1), datetime(2025, 11, 5))),
+    ('от 1 ноября 2025 до 5 ноября 2025', (datetime(2025, 11, 1), datetime(2025, 11, 5))),
+    ('1 ноября 2025 по 5 ноября 2025', (datetime(2025, 11, 1), datetime(2025, 11, 5))),
+    ('1 ноября 2025 - 5 ноября 2025', (datetime(2025, 11, 1), datetime(2025, 11, 5))),
+    ('1 ноября 2025 — 5 ноября 2025', (datetime(2025, 11, 1), datetime(2025, 11, 5))),
+    ('2025-11-01 - 2025-11-05', (datetime(2025, 11, 1), datetime(2025, 11, 5))),
+    ('по 5 ноября 2025', (datetime(2025, 11, 5), datetime(2025, 11, 5))),
+    ('28 ноября 2025 г.', (datetime(2025, 11, 28), datetime(2025, 11, 28))),
+])
+def test_parse_date_range(analytics, date_range, expected):
+    assert analytics.parse_date_range(date_range) == expected
+
+
+# Нераспознанный диапазон не должен превращаться в один день
+@pytest.mark.parametrize('date_range', [
+    '1 ноября 2025 5 ноября 2025',
+    '2025-11-01 2025-11-05',
+    'с 1 ноября 2025 по 5 ноября 2025 по 7 ноября 2025',
+    'примерно по 5 ноября 2025',
+    '1 ноября 2025 - 3 ноября 2025 по 5 ноября 2025',
+])
+def test_parse_date_range_rejects_ambiguous(analytics, date_range):
+    assert analytics.parse_date_range(date_range) == (None, None)
+
+
+@pytest.mark.parametrize('date_str, expected', [
+    ('2025-11-28', datetime(2025, 11, 28)),
+    ('2025-11-28T10:00:00+00:00', datetime(2025, 11, 28)),
+    ('28.11.2025', datetime(2025, 11, 28)),
+    ('28 ноября 2025', datetime(2025, 11, 28)),
+    ('28 нояб. 2025 г.', datetime(2025, 11, 28)),
+    ('28 ноября 2025 и 29 ноября 2025', None),
+    ('2025-11-28 и 2025-11-29', None),
+])
+def test_parse_date(analytics, date_str, expected):
+    assert analytics.parse_date(date_str) == expected
+
+
+# Непригодный ответ модели не кэшируется: повторный вопрос снова уходит модели
+def test_unusable_answer_is_not_cached():
+    analytics = make_analytics('не JSON', VIDEO_COUNT_ANSWER)
+    assert analytics.process_question('Расскажи про видео') == 'Извините, не удалось разобрать ответ модели.'
+    assert analytics.process_question('Расскажи про видео') == '2'
+    assert analytics.ollama_client.calls == 2
+
+
+def test_unresolvable_answer_is_not_cached():
+    analytics = make_analytics(BAD_CREATOR_ANSWER, VIDEO_COUNT_ANSWER)
+    assert analytics.process_question('Расскажи про видео') == \
+        'Извините, не удалось определить метод для ответа на вопрос.'
+    assert analytics.process_question('Расскажи про видео') == '2'
+    assert analytics.ollama_client.calls == 2
+
+
+def test_usable_answer_is_served_from_cache():
+    analytics = make_analytics(VIDEO_COUNT_ANSWER)
+    assert analytics.process_question('Расскажи про видео') == '2'
+    assert analytics.process_question('  расскажи   про видео ') == '2'
+    assert analytics.ollama_client.calls == 1
+    assert (analytics.model_cache.hits, analytics.model_cache.misses) == (1, 1)
+
+
+# В пакете кэшируются только пригодные ответы, остальные вопросы задаются по одному
+def test_batch_leaves_unresolvable_answer_uncached():
+    analytics = make_analytics({'answers': [BAD_CREATOR_ANSWER, VIDEO_COUNT_ANSWER]}, VIDEO_COUNT_ANSWER)
+    assert analytics.process_questions(['Первый вопрос', 'Второй вопрос']) == ['2', '2']
+    # Пакетный запрос и отдельный запрос по первому вопросу
+    assert analytics.ollama_client.calls == 2
+
+
+def test_batch_with_wrong_answer_count_falls_back_to_single_questions():
+    analytics = make_analytics({'answers': [VIDEO_COUNT_ANSWER]}, VIDEO_COUNT_ANSWER, VIDEO_COUNT_ANSWER)
+    assert analytics.process_questions(['Первый вопрос', 'Второй вопрос']) == ['2', '2']
+    assert analytics.ollama_client.calls == 3
+
+
+# Предварительная проверка кэша в process_questions не искажает статистику попаданий
+def test_batch_cache_stats_count_each_question_once():
+    analytics = make_analytics({'answers': [VIDEO_COUNT_ANSWER, VIDEO_COUNT_ANSWER]})
+    assert analytics.process_questions(['Первый вопрос', 'Второй вопрос']) == ['2', '2']
+    assert analytics.ollama_client.calls == 1
+    assert (analytics.model_cache.hits, analytics.model_cache.misses) == (2, 0)